@@ -2,22 +2,40 @@ from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.formparsers import MultiPartParser
 from starlette.requests import Request
+import math
+import asyncio
 import numpy as np
-import librosa
-from PIL import Image, PngImagePlugin
+from scipy import signal
+from scipy.fft import rfft, irfft
+from PIL import Image
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 import soundfile as sf
 import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import shutil
 from typing import Optional
+import hashlib
 import io
-import wave
+import struct
+import threading
+import zlib
 import subprocess
 
 app = FastAPI(title="🎭 Audio Steganography")
 
+# Starlette spills multipart uploads to disk past 1MB; typical audio and
+# carrier images are bigger than that, so keep them in memory instead of
+# paying a disk round-trip per upload
+MultiPartParser.spool_max_size = 32 * 1024 * 1024
+
 # Create directories
 os.makedirs("static", exist_ok=True)
 os.makedirs("templates", exist_ok=True)
@@ -27,25 +45,215 @@ os.makedirs("outputs", exist_ok=True)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/outputs", StaticFiles(directory="outputs"), name="outputs")
 templates = Jinja2Templates(directory="templates")
+
+# Private ancillary PNG chunk that carries the embedded audio payload
+AUDIO_CHUNK = b"auDO"
+
+# Inflated payload cap: ~25 minutes of audio at the default STFT settings.
+# Keeps a crafted chunk from ballooning into an OOM before np.load runs
+MAX_PAYLOAD_BYTES = 128 << 20
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def write_png_chunk(fileobj, chunk_type, data):
+    fileobj.write(struct.pack(">I", len(data)))
+    fileobj.write(chunk_type)
+    fileobj.write(data)
+    fileobj.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+def splice_png_chunk(png_bytes, chunk_type, data, output_fileobj):
+    """
+    Insert a chunk just before IEND without re-encoding the image,
+    dropping any existing chunk of the same type so a re-embed can't
+    leave a stale payload behind.
+    """
+    pos = len(PNG_SIGNATURE)
+    output_fileobj.write(png_bytes[:pos])
+
+    iend = None
+    while pos + 8 <= len(png_bytes):
+        (length,) = struct.unpack_from(">I", png_bytes, pos)
+        ctype = png_bytes[pos + 4:pos + 8]
+        if ctype == b"IEND":
+            iend = pos
+            break
+        if ctype != chunk_type:
+            output_fileobj.write(png_bytes[pos:pos + 12 + length])
+        pos += 12 + length
+    if iend is None:
+        raise ValueError("Base image is not a valid PNG")
+
+    write_png_chunk(output_fileobj, chunk_type, data)
+    output_fileobj.write(png_bytes[iend:])
+
+# Hann windows cached by FFT size so repeated requests skip the setup
+_window_cache = {}
+
+def hann_window(n_fft):
+    window = _window_cache.get(n_fft)
+    if window is None:
+        window = signal.windows.hann(n_fft, sym=False).astype(np.float32)
+        _window_cache[n_fft] = window
+    return window
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _window_frames_jit(span, window, hop_length, out):
+        n_fft = window.shape[0]
+        for t in prange(out.shape[0]):
+            base = t * hop_length
+            for j in range(n_fft):
+                out[t, j] = span[base + j] * window[j]
+
+def window_frames(span, window, hop_length, out):
+    """Windowed frame matrix over a sample span, ready for a batched rfft."""
+    n_fft = window.shape[0]
+    if njit is not None:
+        _window_frames_jit(span, window, hop_length, out)
+    else:
+        frames = np.lib.stride_tricks.sliding_window_view(span, n_fft)[::hop_length]
+        np.multiply(frames, window, out=out)
+    return out
+
+if njit is not None:
+    @njit(fastmath=True, cache=True)
+    def _overlap_add_jit(frames, window, hop_length, out, norm):
+        n_fft = frames.shape[1]
+        for t in range(frames.shape[0]):
+            base = t * hop_length
+            for j in range(n_fft):
+                out[base + j] += frames[t, j] * window[j]
+                norm[base + j] += window[j] * window[j]
+
+def write_wav(fileobj, samples, sr):
+    """Write mono 16-bit PCM WAV: a 44-byte header and one contiguous sample write."""
+    np.clip(samples, -1.0, 1.0, out=samples)
+    samples *= 32767.0
+    pcm = samples.astype(np.int16)
+
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + pcm.nbytes, b"WAVE",
+        b"fmt ", 16, 1, 1, sr, sr * 2, 2, 16,
+        b"data", pcm.nbytes
+    )
+    fileobj.write(header)
+    fileobj.write(pcm.tobytes())
+
+def istft_overlap_add(D, hop_length, length):
+    """
+    Inverse of the embedded STFT layout: one batched irfft over all
+    frames, then windowed overlap-add with window-squared normalization.
+    Mirrors scipy.signal.istft(boundary='zeros') numerically.
+    """
+    n_fft = (D.shape[0] - 1) * 2
+    window = hann_window(n_fft)
+    n_frames = D.shape[1]
+
+    frames = irfft(D.T, axis=1, workers=-1)
+    frames *= window.sum()    # undo the forward 1/win.sum() scaling
+
+    total = (n_frames - 1) * hop_length + n_fft
+    out = np.zeros(total, dtype=np.float32)
+    norm = np.zeros(total, dtype=np.float32)
+
+    if njit is not None:
+        _overlap_add_jit(frames, window, hop_length, out, norm)
+    else:
+        wsq = window * window
+        for t in range(n_frames):
+            base = t * hop_length
+            out[base:base + n_fft] += frames[t] * window
+            norm[base:base + n_fft] += wsq
+
+    nonzero = norm > 1e-10
+    out[nonzero] /= norm[nonzero]
+
+    pad = n_fft // 2
+    return out[pad:pad + length]
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _polar_to_complex_jit(magnitude, phase, out):
+        for i in prange(magnitude.shape[0]):
+            for j in range(magnitude.shape[1]):
+                p = phase[i, j]
+                out[i, j] = magnitude[i, j] * complex(math.cos(p), math.sin(p))
+
+def polar_to_complex(magnitude, phase):
+    """Fuse magnitude * exp(1j*phase) into a single pass with no temporaries."""
+    out = np.empty(magnitude.shape, dtype=np.complex64)
+    if njit is not None:
+        _polar_to_complex_jit(magnitude, phase, out)
+    else:
+        # Real cos/sin hit the vectorized libm paths; complex exp does not
+        out.real = magnitude * np.cos(phase)
+        out.imag = magnitude * np.sin(phase)
+    return out
+
+if njit is not None:
+    # Warm the kernels on the main thread at import: a first launch from a
+    # CONVERT_POOL worker leaves numba's threading layer wedged at
+    # interpreter shutdown (the process never exits), and warming here also
+    # moves the JIT compile cost out of the first request
+    _window_frames_jit(
+        np.zeros(1, dtype=np.float32), np.ones(1, dtype=np.float32), 1,
+        np.zeros((1, 1), dtype=np.float32)
+    )
+    _overlap_add_jit(
+        np.zeros((1, 1), dtype=np.float32), np.ones(1, dtype=np.float32), 1,
+        np.zeros(1, dtype=np.float32), np.zeros(1, dtype=np.float32)
+    )
+    _polar_to_complex_jit(
+        np.zeros((1, 1), dtype=np.float32), np.zeros((1, 1), dtype=np.float32),
+        np.empty((1, 1), dtype=np.complex64)
+    )
+
 class AudioImageConverter:
 
+    def __init__(self):
+        self._ffmpeg_ok = None
+        self._scratch = threading.local()
+
+    def _frame_buffer(self, n_frames, n_fft):
+        """Per-thread scratch for windowed frames, grown once and reused."""
+        buf = getattr(self._scratch, "frames", None)
+        if buf is None or buf.shape[0] < n_frames or buf.shape[1] != n_fft:
+            buf = np.empty((n_frames, n_fft), dtype=np.float32)
+            self._scratch.frames = buf
+        return buf[:n_frames]
+
     def check_ffmpeg(self):
-        """Check if FFmpeg exists."""
-        try:
-            result = subprocess.run(
-                ["ffmpeg", "-version"],
-                capture_output=True,
-                text=True
-            )
-            return result.returncode == 0
-        except:
-            return False
+        """Check if FFmpeg exists (a cached PATH lookup, no fork)."""
+        if self._ffmpeg_ok is None:
+            self._ffmpeg_ok = shutil.which("ffmpeg") is not None
+        return self._ffmpeg_ok
 
-    def ffmpeg_to_wav_bytes(self, fileobj):
+    def pyav_to_pcm(self, fileobj):
         """
-        Convert ANY audio → WAV in memory using FFmpeg pipes.
+        Decode ANY audio → mono float32 samples in-process via libav (PyAV).
+        No fork/exec, no pipes — same codecs as the ffmpeg binary.
+        """
+        import av
+
+        fileobj.seek(0)
+        chunks = []
+        # mode="r" matters: spooled uploads report mode 'w+b', which av.open
+        # would otherwise take as a request for an *output* container
+        with av.open(fileobj, mode="r") as container:
+            resampler = av.AudioResampler(format="s16", layout="mono", rate=22050)
+            for frame in container.decode(audio=0):
+                for resampled in resampler.resample(frame):
+                    chunks.append(resampled.to_ndarray().reshape(-1))
+
+        y = np.concatenate(chunks).astype(np.float32) * (1.0 / 32768.0)
+        return y, 22050
+
+    def ffmpeg_to_pcm(self, fileobj):
+        """
+        Decode ANY audio → mono float32 samples using FFmpeg pipes.
         Input: BytesIO
-        Output: BytesIO (WAV PCM)
+        Output: (samples, sample rate)
         """
         fileobj.seek(0)
         input_bytes = fileobj.read()
@@ -53,24 +261,30 @@ class AudioImageConverter:
         process = subprocess.Popen(
             [
                 "ffmpeg",
+                "-hide_banner",
+                "-loglevel", "error",
+                "-nostdin",
+                "-probesize", "32k",           # don't spend seconds sniffing the input
+                "-analyzeduration", "0",
                 "-i", "pipe:0",
                 "-ac", "1",                    # mono
                 "-ar", "22050",                # sample rate
-                "-acodec", "pcm_s16le",        # 16-bit WAV
-                "-f", "wav",
+                "-f", "s16le",                 # raw 16-bit PCM, no WAV container
                 "pipe:1"
             ],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            bufsize=1 << 20
         )
 
-        wav_data, err = process.communicate(input_bytes)
+        pcm_data, err = process.communicate(input_bytes)
 
         if process.returncode != 0:
             raise Exception("FFmpeg failed: " + err.decode())
 
-        return io.BytesIO(wav_data)
+        y = np.frombuffer(pcm_data, dtype="<i2").astype(np.float32) * (1.0 / 32768.0)
+        return y, 22050
 
     def load_audio(self, fileobj):
         """
@@ -80,83 +294,168 @@ class AudioImageConverter:
         fileobj.seek(0)
 
         try:
-            y, sr = sf.read(fileobj)
+            # Decode straight to float32 — the STFT works in float32 anyway
+            y, sr = sf.read(fileobj, dtype="float32")
             if len(y.shape) > 1:
-                y = np.mean(y, axis=1)
+                channels = y.shape[1]
+                if channels == 2:
+                    # Fused add + in-place halve: one pass, no float64 temp
+                    y = np.add(y[:, 0], y[:, 1], dtype=np.float32)
+                    y *= 0.5
+                else:
+                    y = y.sum(axis=1, dtype=np.float32)
+                    y *= 1.0 / channels
             return y, sr
         except:
             pass
 
-        # Try librosa directly
+        # Try librosa directly (imported lazily: it drags in numba at import time)
         try:
+            import librosa
             fileobj.seek(0)
             y, sr = librosa.load(fileobj, sr=None, mono=True)
             return y, sr
         except:
             pass
 
-        # LAST RESORT: FFmpeg → WAV → soundfile
+        # Try PyAV: libav in-process, skips the fork+exec of a fresh ffmpeg
         try:
-            wav_bytes = self.ffmpeg_to_wav_bytes(fileobj)
-            wav_bytes.seek(0)
-            y, sr = sf.read(wav_bytes)
-            if len(y.shape) > 1:
-                y = np.mean(y, axis=1)
-            return y, sr
+            return self.pyav_to_pcm(fileobj)
+        except:
+            pass
+
+        # LAST RESORT: FFmpeg → raw PCM
+        try:
+            return self.ffmpeg_to_pcm(fileobj)
         except Exception as e:
             raise Exception("All audio loading methods failed: " + str(e))
 
+    def stft_stream(self, sfile, n_fft, hop_length, block=256):
+        """
+        Incremental STFT over an open SoundFile, a block of frames at a time.
+        Matches scipy.signal.stft(boundary='zeros', padded=True), the layout
+        istft_overlap_add inverts on extraction.
+        """
+        window = hann_window(n_fft)
+        pad = n_fft // 2
+        total = sfile.frames
+
+        extended = total + 2 * pad
+        padded = extended + (-(extended - n_fft) % hop_length)
+        n_frames = (padded - n_fft) // hop_length + 1
+
+        out = np.empty((n_fft // 2 + 1, n_frames), dtype=np.complex64)
+
+        for f0 in range(0, n_frames, block):
+            f1 = min(f0 + block, n_frames)
+            # Sample span the batch covers, in zero-extended coordinates
+            start = f0 * hop_length
+            stop = (f1 - 1) * hop_length + n_fft
+            span = np.zeros(stop - start, dtype=np.float32)
+
+            lo = max(start - pad, 0)       # overlap with the real signal
+            hi = min(stop - pad, total)
+            if hi > lo:
+                sfile.seek(lo)
+                data = sfile.read(hi - lo, dtype="float32", always_2d=True)
+                offset = lo + pad - start
+                span[offset:offset + data.shape[0]] = data.mean(axis=1)
+
+            frames = window_frames(span, window, hop_length, self._frame_buffer(f1 - f0, n_fft))
+            out[:, f0:f1] = rfft(frames, axis=1, workers=-1).T
+
+        out *= np.float32(1.0 / window.sum())
+        return out
+
     def audio_to_image(self, audio_fileobj, base_image_fileobj, output_fileobj, n_fft=1024, hop_length=512):
         """Embed audio into PNG in-memory."""
-        audio_data, sr = self.load_audio(audio_fileobj)
+        audio_fileobj.seek(0)
+        try:
+            # Stream straight out of the file: peak memory stays O(spectrogram)
+            # instead of O(waveform + spectrogram)
+            with sf.SoundFile(audio_fileobj) as sfile:
+                sr = sfile.samplerate
+                audio_length = sfile.frames
+                D = self.stft_stream(sfile, n_fft, hop_length)
+        except:
+            audio_data, sr = self.load_audio(audio_fileobj)
+            audio_length = len(audio_data)
+            if audio_length < n_fft:
+                # scipy rejects array windows longer than the raw signal;
+                # zero-pad like the streaming path (and librosa before it)
+                # so both paths accept the same inputs
+                audio_data = np.pad(audio_data, (0, n_fft - audio_length))
+            _, _, D = signal.stft(audio_data, window=hann_window(n_fft), nperseg=n_fft, noverlap=n_fft - hop_length)
+
+        # Quantize: magnitude in log domain as float16, phase mapped to int16.
+        # Reconstruction error stays far below what ISTFT itself introduces.
+        magnitude = np.log1p(np.abs(D)).astype(np.float16)
+        phase = np.round(np.angle(D) * (32767.0 / np.pi)).astype(np.int16)
+
+        payload = io.BytesIO()
+        np.savez(
+            payload,
+            magnitude=magnitude,
+            phase=phase,
+            meta=np.array([sr, hop_length, audio_length], dtype=np.int64)
+        )
 
-        D = librosa.stft(audio_data, n_fft=n_fft, hop_length=hop_length)
-        magnitude = np.abs(D).astype(np.float32)
-        phase = np.angle(D).astype(np.float32)
+        # Level 1 is nearly free and log-magnitude spectrograms deflate well
+        payload_bytes = zlib.compress(payload.getbuffer(), 1)
 
         base_image_fileobj.seek(0)
-        img = Image.open(base_image_fileobj)
-        if img.mode != "RGB":
-            img = img.convert("RGB")
+        base_bytes = base_image_fileobj.read()
 
-        pnginfo = PngImagePlugin.PngInfo()
-        pnginfo.add_text("magnitude", magnitude.tobytes().hex())
-        pnginfo.add_text("phase", phase.tobytes().hex())
-        pnginfo.add_text("shape_0", str(magnitude.shape[0]))
-        pnginfo.add_text("shape_1", str(magnitude.shape[1]))
-        pnginfo.add_text("sample_rate", str(sr))
-        pnginfo.add_text("hop_length", str(hop_length))
-        pnginfo.add_text("original_length", str(len(audio_data)))
+        if base_bytes.startswith(PNG_SIGNATURE):
+            # Already a PNG: reuse its encoded bytes untouched
+            dimensions = struct.unpack(">II", base_bytes[16:24])
+        else:
+            # One-time recompress of non-PNG carriers; the payload is
+            # spliced below either way, so PIL never re-encodes for it
+            img = Image.open(io.BytesIO(base_bytes))
+            if img.mode != "RGB":
+                img = img.convert("RGB")
 
-        img.save(output_fileobj, "PNG", pnginfo=pnginfo)
+            encoded = io.BytesIO()
+            img.save(encoded, "PNG", compress_level=1, optimize=False)
+            base_bytes = encoded.getvalue()
+            dimensions = img.size
+
+        splice_png_chunk(base_bytes, AUDIO_CHUNK, payload_bytes, output_fileobj)
 
         return {
-            "duration": len(audio_data) / sr,
+            "duration": audio_length / sr,
             "sample_rate": sr,
-            "dimensions": img.size
+            "dimensions": dimensions
         }
 
     def image_to_audio(self, image_fileobj, output_audioobj):
         """Extract audio from image in memory."""
         image_fileobj.seek(0)
         img = Image.open(image_fileobj)
+        # The payload chunk sits after IDAT, so parse the full stream
+        img.load()
 
-        if "magnitude" not in img.info:
+        # Entries are (cid, data) before IDAT and (cid, data, True) after
+        chunk = next((c[1] for c in img.private_chunks if c[0] == AUDIO_CHUNK), None)
+        if chunk is None:
             raise ValueError("This image has no embedded audio")
 
-        shape_0 = int(img.info["shape_0"])
-        shape_1 = int(img.info["shape_1"])
-        sr = int(img.info["sample_rate"])
-        hop_length = int(img.info["hop_length"])
-        original_length = int(img.info["original_length"])
+        inflater = zlib.decompressobj()
+        payload_bytes = inflater.decompress(chunk, MAX_PAYLOAD_BYTES)
+        if inflater.unconsumed_tail:
+            raise ValueError("Embedded audio payload is too large")
+
+        payload = np.load(io.BytesIO(payload_bytes))
+        sr, hop_length, original_length = (int(v) for v in payload["meta"])
 
-        magnitude = np.frombuffer(bytes.fromhex(img.info["magnitude"]), dtype=np.float32).reshape(shape_0, shape_1)
-        phase = np.frombuffer(bytes.fromhex(img.info["phase"]), dtype=np.float32).reshape(shape_0, shape_1)
+        magnitude = np.expm1(payload["magnitude"].astype(np.float32))
+        phase = payload["phase"].astype(np.float32) * (np.pi / 32767.0)
 
-        D = magnitude * np.exp(1j * phase)
-        y = librosa.istft(D, hop_length=hop_length, length=original_length)
+        D = polar_to_complex(magnitude, phase)
+        y = istft_overlap_add(D, hop_length, original_length)
 
-        sf.write(output_audioobj, y, sr, format='WAV')
+        write_wav(output_audioobj, y, sr)
 
         return {
             "duration": len(y) / sr,
@@ -165,6 +464,11 @@ class AudioImageConverter:
 
 converter = AudioImageConverter()
 
+# Conversion pool: numpy/PIL release the GIL in their C sections, so one
+# worker per core lets concurrent embeds overlap instead of sharing
+# asyncio's small default pool with every other to_thread user
+CONVERT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
@@ -195,25 +499,35 @@ async def embed_audio(
     hop_length: int = Form(512)
 ):
     try:
-        # Convert files to memory buffers
-        audio_bytes = io.BytesIO(await audio_file.read())
-        image_bytes = io.BytesIO(await image_file.read())
+        # Uploads are already spooled to temp files by starlette; hand the
+        # file objects over directly instead of copying them again
+        audio_bytes = audio_file.file
+        image_bytes = image_file.file
         output_bytes = io.BytesIO()
 
-        result = converter.audio_to_image(
-            audio_fileobj=audio_bytes,
-            base_image_fileobj=image_bytes,
-            output_fileobj=output_bytes,
-            n_fft=n_fft,
-            hop_length=hop_length
+        # CPU-bound (STFT + PNG encode): run off the event loop
+        result = await asyncio.get_running_loop().run_in_executor(
+            CONVERT_POOL,
+            converter.audio_to_image,
+            audio_bytes,
+            image_bytes,
+            output_bytes,
+            n_fft,
+            hop_length
         )
 
+        size = output_bytes.tell()
+        etag = hashlib.blake2b(output_bytes.getbuffer(), digest_size=16).hexdigest()
         output_bytes.seek(0)
 
         return StreamingResponse(
             output_bytes,
             media_type="image/png",
-            headers={"Content-Disposition": "attachment; filename=embedded.png"}
+            headers={
+                "Content-Disposition": "attachment; filename=embedded.png",
+                "Content-Length": str(size),
+                "ETag": f'"{etag}"'
+            }
         )
 
     except Exception as e:
@@ -222,20 +536,27 @@ async def embed_audio(
 @app.post("/api/extract")
 async def extract_audio(image_file: UploadFile = File(...)):
     try:
-        image_bytes = io.BytesIO(await image_file.read())
+        image_bytes = image_file.file
         output_bytes = io.BytesIO()
 
-        result = converter.image_to_audio(
-            image_fileobj=image_bytes,
-            output_audioobj=output_bytes
+        # CPU-bound (PNG decode + ISTFT): run off the event loop
+        result = await asyncio.get_running_loop().run_in_executor(
+            CONVERT_POOL,
+            converter.image_to_audio,
+            image_bytes,
+            output_bytes
         )
 
+        size = output_bytes.tell()
         output_bytes.seek(0)
 
         return StreamingResponse(
             output_bytes,
             media_type="audio/wav",
-            headers={"Content-Disposition": "attachment; filename=extracted.wav"}
+            headers={
+                "Content-Disposition": "attachment; filename=extracted.wav",
+                "Content-Length": str(size)
+            }
         )
 
     except Exception as e:
@@ -256,13 +577,16 @@ async def download_file(file_id: str, file_type: str):
     else:
         raise HTTPException(status_code=400, detail="Invalid file type")
     
-    if not os.path.exists(file_path):
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
-    
+
     return FileResponse(
-        file_path, 
-        media_type=media_type, 
+        file_path,
+        media_type=media_type,
         filename=filename,
+        stat_result=stat_result,
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
     
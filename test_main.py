@@ -0,0 +1,71 @@
+"""Regression tests for upload decoding edge cases."""
+import io
+import tempfile
+
+import numpy as np
+import pytest
+import soundfile as sf
+from PIL import Image
+
+import main
+
+
+def aac_bytes(samples, sr=22050):
+    """Encode samples as ADTS/AAC — a format libsndfile can't open."""
+    av = pytest.importorskip("av")
+    buf = io.BytesIO()
+    with av.open(buf, mode="w", format="adts") as container:
+        stream = container.add_stream("aac", rate=sr, layout="mono")
+        frame = av.AudioFrame.from_ndarray(samples[np.newaxis, :], format="fltp", layout="mono")
+        frame.sample_rate = sr
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buf.getvalue()
+
+
+def base_png():
+    img = Image.fromarray(np.zeros((32, 32, 3), dtype=np.uint8), "RGB")
+    out = io.BytesIO()
+    img.save(out, "PNG")
+    out.seek(0)
+    return out
+
+
+def test_pyav_decodes_spooled_upload():
+    # Spooled uploads report mode 'w+b'; av.open must not take that as a
+    # request for an output container
+    t = np.arange(22050) / 22050.0
+    data = aac_bytes((0.3 * np.sin(2 * np.pi * 440 * t)).astype(np.float32))
+
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as spool:
+        spool.write(data)
+        y, sr = main.converter.pyav_to_pcm(spool)
+
+    assert sr == 22050
+    assert len(y) > 0
+
+
+def test_embed_pads_short_clips_in_scipy_fallback(monkeypatch):
+    # Clips shorter than n_fft must survive the non-streaming fallback;
+    # scipy rejects array windows longer than the unpadded signal
+    short = (0.1 * np.sin(np.linspace(0, 20, 300))).astype(np.float32)
+
+    def fail_open(*args, **kwargs):
+        raise RuntimeError("not a soundfile format")
+
+    embedded = io.BytesIO()
+    with monkeypatch.context() as patched:
+        patched.setattr(main.sf, "SoundFile", fail_open)
+        patched.setattr(main.converter, "load_audio", lambda fileobj: (short, 22050))
+        info = main.converter.audio_to_image(io.BytesIO(b"x"), base_png(), embedded)
+    assert info["sample_rate"] == 22050
+
+    embedded.seek(0)
+    extracted = io.BytesIO()
+    main.converter.image_to_audio(embedded, extracted)
+    extracted.seek(0)
+    y, sr = sf.read(extracted)
+    assert sr == 22050
+    assert len(y) == len(short)